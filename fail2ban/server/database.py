@@ -551,17 +551,40 @@ class Fail2BanDb(object):
 		return self._addLog(cur, jail, name, time, iso); # no hash, just time as iso
 
 	@commitandrollback
-	def updateJournal(self, cur, jail, name, time, iso):
-		"""Updates last position (as time) of journal.
+	def getJournalCursor(self, cur, jail, name):
+		"""Get last known cursor of journal from database.
 
 		Parameters
 		----------
 		jail : Jail
 			Jail of which the journal belongs to.
-		name, time, iso :
-			Journal name (typically systemd-journal) and last known time.
+		name :
+			Journal name (typically systemd-journal).
+
+		Returns
+		-------
+		str
+			Last cursor if it was already present in database; else `None`
+		"""
+		cur.execute(
+			"SELECT firstlinemd5 FROM logs "
+				"WHERE jail=? AND path=?",
+			(jail.name, name))
+		row = cur.fetchone()
+		return row[0] if row else None
+
+	@commitandrollback
+	def updateJournal(self, cur, jail, name, time, cursor):
+		"""Updates last position (as time and cursor) of journal.
+
+		Parameters
+		----------
+		jail : Jail
+			Jail of which the journal belongs to.
+		name, time, cursor :
+			Journal name (typically systemd-journal), last known time and cursor.
 		"""
-		self._updateLog(cur, jail, name, time, iso); # no hash, just time as iso
+		self._updateLog(cur, jail, name, time, cursor); # no hash, just time and cursor
 
 	@commitandrollback
 	def addBan(self, cur, jail, ticket):
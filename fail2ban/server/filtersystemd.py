@@ -23,22 +23,27 @@ __copyright__ = "Copyright (c) 2013 Steven Hiscocks"
 __license__ = "GPL"
 
 import os
+import re
 import time
-from distutils.version import LooseVersion
+from threading import Event
 
 from systemd import journal
-if LooseVersion(getattr(journal, '__version__', "0")) < '204':
+if tuple(int(v) for v in getattr(journal, '__version__', "0").split('.') if v.isdigit()) < (204,):
 	raise ImportError("Fail2Ban requires systemd >= 204")
 
 from .failmanager import FailManagerEmpty
 from .filter import JournalFilter, Filter
 from .mytime import MyTime
 from .utils import Utils
-from ..helpers import getLogger, logging, splitwords, uni_decode
+from ..helpers import getLogger, logging, splitwords, uni_decode, uni_bytes
 
 # Gets the instance of the logger.
 logSys = getLogger(__name__)
 
+# Valid journal match element "FIELD=value" (field name of upper-case letters, digits
+# and underscores, not starting with "__", see match_is_valid of sd-journal):
+JOURNAL_MATCH_CRE = re.compile(r"(?!__)[A-Z0-9_]+=")
+
 
 ##
 # Journal reader class.
@@ -56,11 +61,25 @@ class FilterSystemd(JournalFilter): # pragma: systemd no cover
 
 	def __init__(self, jail, **kwargs):
 		jrnlargs = FilterSystemd._getJournalArgs(kwargs)
+		batchSize = int(kwargs.pop('journalbatch', 100))
 		JournalFilter.__init__(self, jail, **kwargs)
 		self.__modified = 0
+		## Max count of entries processed at once (before going to wait or service tasks):
+		self.__batchSize = max(1, batchSize)
+		## Encoding to decode journal entries (cached, see setLogEncoding):
+		self.__encoding = self.getLogEncoding()
 		# Initialise systemd-journal connection
+		self.__jrnlargs = jrnlargs
 		self.__journal = journal.Reader(**jrnlargs)
+		## Cursor of last processed entry (to restore position if journal gets reopened):
+		self.__lastCursor = None
+		## Wakeup event (set by stop, interrupts sleep in idle mode):
+		self.__wakeup = Event()
 		self.__matches = []
+		## Index of matches (tuple of match elements to position in matches list):
+		self.__matchesIdx = {}
+		## Cached representation of matches (for status):
+		self.__matchesRepr = None
 		self.setDatePattern(None)
 		logSys.debug("Created FilterSystemd")
 
@@ -78,13 +97,12 @@ class FilterSystemd(JournalFilter): # pragma: systemd no cover
 			pass
 		else:
 			import glob
+			from itertools import chain
 			p = args['files']
 			if not isinstance(p, (list, set, tuple)):
 				p = splitwords(p)
-			files = []
-			for p in p:
-				files.extend(glob.glob(p))
-			args['files'] = list(set(files))
+			# expand globs, remove duplicates (preserving order):
+			args['files'] = list(dict.fromkeys(chain.from_iterable(map(glob.glob, p))))
 
 		# Default flags is SYSTEM_ONLY(4). This would lead to ignore user session files,
 		# so can prevent "Too many open files" errors on a lot of user sessions (see gh-2392):
@@ -108,16 +126,21 @@ class FilterSystemd(JournalFilter): # pragma: systemd no cover
 	# @param matches list structure with journal matches
 
 	def _addJournalMatches(self, matches):
+		# local binding (avoid attribute lookups by large match lists, e. g. on reset):
+		addMatch = self.__journal.add_match
+		addDisjunction = self.__journal.add_disjunction
 		if self.__matches:
-			self.__journal.add_disjunction() # Add OR
+			addDisjunction() # Add OR
 		newMatches = []
 		for match in matches:
-			newMatches.append([])
-			for match_element in match:
-				self.__journal.add_match(match_element)
-				newMatches[-1].append(match_element)
-			self.__journal.add_disjunction()
+			match = list(match)
+			addMatch(*match) # all elements of conjunction at once (AND)
+			addDisjunction()
+			newMatches.append(match)
+		for i, match in enumerate(newMatches, len(self.__matches)):
+			self.__matchesIdx.setdefault(tuple(match), i)
 		self.__matches.extend(newMatches)
+		self.__matchesRepr = None
 
 	##
 	# Add a journal match filter
@@ -127,20 +150,29 @@ class FilterSystemd(JournalFilter): # pragma: systemd no cover
 	def addJournalMatch(self, match):
 		newMatches = [[]]
 		for match_element in match:
-			if match_element == "+":
+			if match_element in ("+", b"+"):
 				newMatches.append([])
-			else:
-				newMatches[-1].append(match_element)
+				continue
+			# validate before adding (so wrong element doesn't cause restore of all matches):
+			if not isinstance(match_element, (str, bytes)) \
+			  or not JOURNAL_MATCH_CRE.match(uni_decode(match_element)):
+				logSys.error(
+					"Error adding journal match for: %r", " ".join(map(uni_decode, match)))
+				raise ValueError("Invalid journal match %r" % (match_element,))
+			# store and pass to journal as bytes (avoid encoding by each add_match, e. g. on reset):
+			if isinstance(match_element, str):
+				match_element = uni_bytes(match_element)
+			newMatches[-1].append(match_element)
 		try:
 			self._addJournalMatches(newMatches)
 		except ValueError:
 			logSys.error(
-				"Error adding journal match for: %r", " ".join(match))
+				"Error adding journal match for: %r", " ".join(map(uni_decode, match)))
 			self.resetJournalMatches()
 			raise
 		else:
 			logSys.info("[%s] Added journal match for: %r", self.jailName, 
-				" ".join(match))
+				" ".join(map(uni_decode, match)))
 	##
 	# Reset a journal match filter called on removal or failure
 	#
@@ -151,6 +183,8 @@ class FilterSystemd(JournalFilter): # pragma: systemd no cover
 		logSys.debug("[%s] Flushed all journal matches", self.jailName)
 		match_copy = self.__matches[:]
 		self.__matches = []
+		self.__matchesIdx = {}
+		self.__matchesRepr = None
 		try:
 			self._addJournalMatches(match_copy)
 		except ValueError:
@@ -171,10 +205,13 @@ class FilterSystemd(JournalFilter): # pragma: systemd no cover
 				return
 			del self.__matches[:]
 		# delete by index:
-		elif match in self.__matches:
-			del self.__matches[self.__matches.index(match)]
 		else:
-			raise ValueError("Match %r not found" % match)
+			try:
+				idx = self.__matchesIdx[tuple(
+					uni_bytes(v) if isinstance(v, str) else v for v in match)]
+			except (KeyError, TypeError):
+				raise ValueError("Match %r not found" % match)
+			del self.__matches[idx]
 		self.resetJournalMatches()
 		logSys.info("[%s] Removed journal match for: %r", self.jailName, 
 			match if match else '*')
@@ -185,7 +222,7 @@ class FilterSystemd(JournalFilter): # pragma: systemd no cover
 	# @return journalctl syntax matches
 
 	def getJournalMatch(self):
-		return self.__matches
+		return [[uni_decode(v, 'utf-8') for v in match] for match in self.__matches]
 
 	##
 	# Get journal reader
@@ -195,12 +232,28 @@ class FilterSystemd(JournalFilter): # pragma: systemd no cover
 	def getJournalReader(self):
 		return self.__journal
 
+	##
+	# Set the log encoding
+	#
+	# @param encoding the encoding used to decode journal entries
+
+	def setLogEncoding(self, encoding):
+		encoding = super(FilterSystemd, self).setLogEncoding(encoding)
+		self.__encoding = encoding
+		return encoding
+
+	def uni_decode(self, x):
+		""" Decodes bytes of journal entry field using log encoding (returns string as is)."""
+		if isinstance(x, bytes):
+			return x.decode(self.__encoding, 'replace')
+		return x
+
 	def getJrnEntTime(self, logentry):
 		""" Returns time of entry as tuple (ISO-str, Posix)."""
 		date = logentry.get('_SOURCE_REALTIME_TIMESTAMP')
 		if date is None:
-				date = logentry.get('__REALTIME_TIMESTAMP')
-		return (date.isoformat(), time.mktime(date.timetuple()) + date.microsecond/1.0E6)
+			date = logentry.get('__REALTIME_TIMESTAMP')
+		return (date.isoformat(), date.timestamp())
 
 	##
 	# Format journal log entry into syslog style
@@ -209,54 +262,129 @@ class FilterSystemd(JournalFilter): # pragma: systemd no cover
 	# @return format log line
 
 	def formatJournalEntry(self, logentry):
-		# Be sure, all argument of line tuple should have the same type:
-		enc = self.getLogEncoding()
+		# hot path (called for each entry), so use local bindings (bytes decoded
+		# with log encoding), all items of line tuple are strings:
+		uni_decode = self.uni_decode
+		get = logentry.get
 		logelements = []
-		v = logentry.get('_HOSTNAME')
+		append = logelements.append
+		v = get('_HOSTNAME')
 		if v:
-			logelements.append(uni_decode(v, enc))
-		v = logentry.get('SYSLOG_IDENTIFIER')
-		if not v:
-			v = logentry.get('_COMM')
+			append(uni_decode(v))
+		v = get('SYSLOG_IDENTIFIER') or get('_COMM')
 		if v:
-			logelements.append(uni_decode(v, enc))
-			v = logentry.get('SYSLOG_PID')
-			if not v:
-				v = logentry.get('_PID')
+			ident = uni_decode(v)
+			v = get('SYSLOG_PID') or get('_PID')
 			if v:
 				try: # [integer] (if already numeric):
-					v = "[%i]" % v
+					ident = "%s[%i]:" % (ident, v)
 				except TypeError:
 					try: # as [integer] (try to convert to int):
-						v = "[%i]" % int(v, 0)
+						ident = "%s[%i]:" % (ident, int(v, 0))
 					except (TypeError, ValueError): # fallback - [string] as it is
-						v = "[%s]" % v
-				logelements[-1] += v
-			logelements[-1] += ":"
-			if logelements[-1] == "kernel:":
-				monotonic = logentry.get('_SOURCE_MONOTONIC_TIMESTAMP')
+						ident = "%s[%s]:" % (ident, v)
+				append(ident)
+			elif ident != "kernel":
+				append(ident + ":")
+			else: # kernel messages (without pid) - add monotonic time:
+				append("kernel:")
+				monotonic = get('_SOURCE_MONOTONIC_TIMESTAMP')
 				if monotonic is None:
-					monotonic = logentry.get('__MONOTONIC_TIMESTAMP')[0]
-				logelements.append("[%12.6f]" % monotonic.total_seconds())
-		msg = logentry.get('MESSAGE','')
+					monotonic = logentry['__MONOTONIC_TIMESTAMP'][0]
+				append("[%12.6f]" % monotonic.total_seconds())
+		msg = get('MESSAGE', '')
 		if isinstance(msg, list):
-			logelements.append(" ".join(uni_decode(v, enc) for v in msg))
+			append(" ".join(map(uni_decode, msg)))
 		else:
-			logelements.append(uni_decode(msg, enc))
+			append(uni_decode(msg))
 
 		logline = " ".join(logelements)
 
 		date = self.getJrnEntTime(logentry)
-		logSys.log(5, "[%s] Read systemd journal entry: %s %s", self.jailName,
-			date[0], logline)
-		## use the same type for 1st argument:
-		return ((logline[:0], date[0] + ' ', logline.replace('\n', '\\n')), date[1])
+		if logSys.isEnabledFor(5):
+			logSys.log(5, "[%s] Read systemd journal entry: %s %s", self.jailName,
+				date[0], logline)
+		return (("", date[0] + ' ', logline.replace('\n', '\\n')), date[1])
 
 	def seekToTime(self, date):
 		if isinstance(date, int):
 			date = float(date)
 		self.__journal.seek_realtime(date)
 
+	def seekToCursor(self, cursor):
+		"""Seeks to the entry with given cursor (next read continues after it).
+
+		Returns False if cursor is invalid or the entry is not available anymore
+		(e. g. by rotation or vacuuming).
+		"""
+		try:
+			self.__journal.seek_cursor(cursor)
+			self.__journal.get_next()
+			return self.__journal.test_cursor(cursor)
+		except (OSError, ValueError) as e:
+			logSys.debug("[%s] Seek to cursor %r failed: %r", self.jailName, cursor, e)
+			return False
+
+	def _checkJournalStale(self, since):
+		"""Checks the reader doesn't hang after rotation (gh-3396), reopens journal if it does.
+
+		A new reader (with the same matches) gets positioned after the last processed
+		entry (or at time `since` if not known). The current reader is stale only if
+		the new reader finds a matching entry, which the current reader doesn't return,
+		so a jail simply having no new matching entries keeps its reader.
+
+		Returns True if journal was reopened.
+		"""
+		stale = False
+		try:
+			jnl = journal.Reader(**self.__jrnlargs)
+		except OSError as e:
+			logSys.debug("[%s] Check of journal reader failed: %r", self.jailName, e)
+			return stale
+		try:
+			for match in self.__matches:
+				jnl.add_match(*match)
+				jnl.add_disjunction()
+			cursor = self.__lastCursor
+			if cursor:
+				try:
+					jnl.seek_cursor(cursor)
+					jnl.get_next()
+					if not jnl.test_cursor(cursor):
+						cursor = None
+				except (OSError, ValueError):
+					cursor = None
+			if not cursor:
+				jnl.seek_realtime(float(since))
+			# new reader finds an entry (move back to read it hereafter):
+			if jnl.get_next():
+				jnl.get_previous()
+				# check the current reader returns it too:
+				if self.__journal.get_next():
+					self.__journal.get_previous()
+				else:
+					stale = True
+		except OSError as e:
+			logSys.debug("[%s] Check of journal reader failed: %r", self.jailName, e)
+		if stale:
+			logSys.info("[%s] Journal reader hangs after rotation, reopen journal", self.jailName)
+			jnl, self.__journal = self.__journal, jnl
+		# close unused reader (new one or stale):
+		try:
+			jnl.close()
+		except Exception as e: # pragma: no cover
+			logSys.error("Close journal failed: %r", e,
+				exc_info=logSys.getEffectiveLevel()<=logging.DEBUG)
+		return stale
+
+	def _adaptBatchSize(self, batchSize, failures):
+		"""Returns size of next batch (adapted by found failures of the full batch)."""
+		if failures:
+			# failures found - shrink batch to handle bans and service tasks earlier:
+			return max(self.__batchSize, batchSize // 2)
+		# no failures (pure catch-up) - grow batch (up to 10 times of journalbatch):
+		return min(self.__batchSize * 10, batchSize * 2)
+
 	def inOperationMode(self):
 		self.inOperation = True
 		logSys.info("[%s] Jail is in operation now (process new journal entries)", self.jailName)
@@ -269,7 +397,7 @@ class FilterSystemd(JournalFilter): # pragma: systemd no cover
 
 	def run(self):
 
-		if not self.getJournalMatch():
+		if not self.__matches:
 			logSys.notice(
 				"[%s] Jail started without 'journalmatch' set. "
 				"Jail regexs will be checked against all journal entries, "
@@ -284,14 +412,21 @@ class FilterSystemd(JournalFilter): # pragma: systemd no cover
 				self.__journal.get_next()
 		except OSError:
 			logentry = None # Reading failure, so safe to ignore
+		seekBack = True
 		if logentry:
-			# Try to obtain the last known time (position of journal)
+			# Try to obtain the last known time and cursor (position of journal)
 			startTime = 0
+			cursor = None
 			if self.jail.database is not None:
 				startTime = self.jail.database.getJournalPos(self.jail, 'systemd-journal') or 0
-			# Seek to max(last_known_time, now - findtime) in journal
-			startTime = max( startTime, MyTime.time() - int(self.getFindTime()) )
-			self.seekToTime(startTime)
+				cursor = self.jail.database.getJournalCursor(self.jail, 'systemd-journal')
+			findStart = MyTime.time() - int(self.getFindTime())
+			# Seek to last known cursor if it is not obsolete (resume exactly after last processed entry),
+			# otherwise seek to max(last_known_time, now - findtime) in journal
+			if cursor and startTime >= findStart and self.seekToCursor(cursor):
+				seekBack = False
+			else:
+				self.seekToTime(max(startTime, findStart))
 			# Not in operation while we'll read old messages ...
 			self.inOperation = False
 			# Save current time in order to check time to switch "in operation" mode
@@ -307,13 +442,19 @@ class FilterSystemd(JournalFilter): # pragma: systemd no cover
 
 		# Move back one entry to ensure do not end up in dead space
 		# if start time beyond end of journal
-		try:
-			self.__journal.get_previous()
-		except OSError:
-			pass # Reading failure, so safe to ignore
+		if seekBack:
+			try:
+				self.__journal.get_previous()
+			except OSError:
+				pass # Reading failure, so safe to ignore
 
 		wcode = journal.NOP
 		line = None
+		# count of entries processed at once (adaptive, see below):
+		batchSize = self.__batchSize
+		# time of next check the reader doesn't hang after rotation (None - no check),
+		# delay between checks and time of rotation:
+		staleCheck = staleDelay = staleSince = None
 		while self.active:
 			# wait for records (or for timeout in sleeptime seconds):
 			try:
@@ -343,25 +484,28 @@ class FilterSystemd(JournalFilter): # pragma: systemd no cover
 								if self.__journal.get_previous(): self.__journal.get_next()
 							except OSError:
 								pass
+						# check the reader gets new entries after rotation:
+						staleSince = MyTime.time()
+						staleDelay = self.sleeptime
+						staleCheck = staleSince + staleDelay
 				if self.idle:
 					# because journal.wait will returns immediatelly if we have records in journal,
-					# just wait a little bit here for not idle, to prevent hi-load:
-					if not Utils.wait_for(lambda: not self.active or not self.idle, 
-						self.sleeptime * 10, self.sleeptime
-					):
+					# just wait a little bit here for not idle, to prevent hi-load
+					# (sleep on wakeup event, so stop interrupts it immediately):
+					self.__wakeup.wait(self.sleeptime)
+					if self.active and self.idle:
 						self.ticks += 1
 						continue
 				self.__modified = 0
-				while self.active:
-					logentry = None
-					try:
-						logentry = self.__journal.get_next()
-					except OSError as e:
-						logSys.error("Error reading line from systemd journal: %s",
-							e, exc_info=logSys.getEffectiveLevel() <= logging.DEBUG)
-					self.ticks += 1
-					if logentry:
-						line, tm = self.formatJournalEntry(logentry)
+				wcode = journal.NOP; # enter wait if no more entries to process
+				# local binding to avoid attribute lookups per entry:
+				formatJournalEntry = self.formatJournalEntry
+				processLineAndAdd = self.processLineAndAdd
+				failTotal = self.failManager.getFailTotal()
+				try:
+					for logentry in self.__journal:
+						self.ticks += 1
+						line, tm = formatJournalEntry(logentry)
 						# switch "in operation" mode if we'll find start entry (+ some delta):
 						if not self.inOperation:
 							if tm >= MyTime.time() - 1: # reached now (approximated):
@@ -373,25 +517,42 @@ class FilterSystemd(JournalFilter): # pragma: systemd no cover
 									startTime = (0, MyTime.time()*2 - startTime[1])
 							elif tm > startTime[1]: # reached start time (approximated):
 								self.inOperationMode()
-						# process line
-						self.processLineAndAdd(line, tm)
+						# process line (tickets are banned inside as soon as ID reached maxretry,
+						# so the bans don't wait for the end of the batch):
+						processLineAndAdd(line, tm)
 						self.__modified += 1
-						if self.__modified >= 100: # todo: should be configurable
+						if self.__modified >= batchSize or not self.active:
 							wcode = journal.APPEND; # don't need wait - there are still unprocessed entries
 							break
-					else:
-						# "in operation" mode since we don't have messages anymore (reached end of journal):
-						if not self.inOperation:
-							self.inOperationMode()
-						wcode = journal.NOP; # enter wait - no more entries to process
-						break
+				except OSError as e:
+					logSys.error("Error reading line from systemd journal: %s",
+						e, exc_info=logSys.getEffectiveLevel() <= logging.DEBUG)
+				if wcode == journal.NOP:
+					self.ticks += 1
+					# "in operation" mode since we don't have messages anymore (reached end of journal):
+					if not self.inOperation:
+						self.inOperationMode()
+				else:
+					batchSize = self._adaptBatchSize(batchSize,
+						self.failManager.getFailTotal() != failTotal)
+				if self.__modified:
+					self.__lastCursor = logentry.get('__CURSOR')
+					staleCheck = None
+				elif staleCheck is not None and MyTime.time() >= staleCheck:
+					# no entries after rotation - reader may hang in dead space (gh-3396):
+					if self._checkJournalStale(staleSince):
+						staleCheck = None
+						wcode = journal.APPEND; # read entries of new reader without wait
+					else: # check again later (with increasing delay):
+						staleDelay = min(staleDelay * 2, self.sleeptime * 64)
+						staleCheck = MyTime.time() + staleDelay
 				self.__modified = 0
 				if self.ticks % 10 == 0:
 					self.performSvc()
-				# update position in log (time and iso string):
+				# update position in log (time and cursor):
 				if self.jail.database:
 					if line:
-						self._pendDBUpdates['systemd-journal'] = (tm, line[1])
+						self._pendDBUpdates['systemd-journal'] = (tm, logentry.get('__CURSOR'))
 						line = None
 					if self._pendDBUpdates and (
 				    self.ticks % 100 == 0
@@ -429,8 +590,9 @@ class FilterSystemd(JournalFilter): # pragma: systemd no cover
 
 	def status(self, flavor="basic"):
 		ret = super(FilterSystemd, self).status(flavor=flavor)
-		ret.append(("Journal matches",
-			[" + ".join(" ".join(match) for match in self.__matches)]))
+		if self.__matchesRepr is None:
+			self.__matchesRepr = " + ".join(" ".join(match) for match in self.getJournalMatch())
+		ret.append(("Journal matches", [self.__matchesRepr]))
 		return ret
 
 	def _updateDBPending(self):
@@ -444,6 +606,12 @@ class FilterSystemd(JournalFilter): # pragma: systemd no cover
 				break
 			db.updateJournal(self.jail, log, *args)
 
+	def stop(self):
+		"""Stop monitoring of journal (wakes up the filter if it sleeps in idle mode).
+		"""
+		super(FilterSystemd, self).stop()
+		self.__wakeup.set()
+
 	def onStop(self):
 		"""Stop monitoring of journal. Invoked after run method.
 		"""
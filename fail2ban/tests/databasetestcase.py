@@ -267,10 +267,12 @@ class DatabaseTest(LogCaptureTestCase):
 		self.testAddJail() # Jail required
 		# not yet updated:
 		self.assertEqual(self.db.getJournalPos(self.jail, 'systemd-journal'), None)
+		self.assertEqual(self.db.getJournalCursor(self.jail, 'systemd-journal'), None)
 		# update 3 times (insert and 2 updates) and check it was set (and overwritten):
 		for t in (1500000000, 1500000001, 1500000002):
 			self.db.updateJournal(self.jail, 'systemd-journal', t, 'TEST'+str(t))
 			self.assertEqual(self.db.getJournalPos(self.jail, 'systemd-journal'), t)
+			self.assertEqual(self.db.getJournalCursor(self.jail, 'systemd-journal'), 'TEST'+str(t))
 
 	def testAddBan(self):
 		self.testAddJail()
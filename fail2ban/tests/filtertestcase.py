@@ -1461,6 +1461,33 @@ def get_monitor_failures_journal_testcase(Filter_): # pragma: systemd no cover
 		def testJournalFlagsArg(self):
 			self._initFilter(journalflags=0) # e. g. 2 - journal.RUNTIME_ONLY
 
+		def testJournalBatchArg(self):
+			self._initFilter(journalbatch=5)
+			# grows by catch-up without failures (up to 10 times of journalbatch):
+			batchSize = 5
+			for i in range(5):
+				batchSize = self.filter._adaptBatchSize(batchSize, False)
+			self.assertEqual(batchSize, 50)
+			# shrinks back to journalbatch as soon as failures are found:
+			batchSize = self.filter._adaptBatchSize(batchSize, True)
+			self.assertEqual(batchSize, 25)
+			for i in range(5):
+				batchSize = self.filter._adaptBatchSize(batchSize, True)
+			self.assertEqual(batchSize, 5)
+			# invalid value (at least 1 entry per batch):
+			self._initFilter(journalbatch=0)
+			self.assertEqual(self.filter._adaptBatchSize(1, True), 1)
+			self.assertEqual(self.filter._adaptBatchSize(1, False), 2)
+
+		def _gen_failure(self, ip, check=True):
+			# insert new failure and check it is monitored:
+			fields = self.journal_fields
+			fields.update(TEST_JOURNAL_FIELDS)
+			journal.send(MESSAGE="error: PAM: Authentication failure for test from "+ip, **fields)
+			if check:
+				self.waitForTicks(1)
+				self.assert_correct_ban(ip, 1)
+
 		def assert_correct_ban(self, test_ip, test_attempts):
 			self.assertTrue(self.waitFailTotal(test_attempts, 10)) # give Filter a chance to react
 			ticket = self.jail.getFailTicket()
@@ -1520,15 +1547,6 @@ def get_monitor_failures_journal_testcase(Filter_): # pragma: systemd no cover
 
 		@with_alt_time
 		def test_grow_file_with_db(self):
-
-			def _gen_falure(ip):
-				# insert new failures ans check it is monitored:
-				fields = self.journal_fields
-				fields.update(TEST_JOURNAL_FIELDS)
-				journal.send(MESSAGE="error: PAM: Authentication failure for test from "+ip, **fields)
-				self.waitForTicks(1)
-				self.assert_correct_ban(ip, 1)
-
 			# coverage for update log:
 			self.jail.database = getFail2BanDb(':memory:')
 			self.jail.database.addJail(self.jail)
@@ -1547,7 +1565,7 @@ def get_monitor_failures_journal_testcase(Filter_): # pragma: systemd no cover
 			self.filter.start()
 			self.waitForTicks(2)
 			# check new IP but no old IPs found:
-			_gen_falure("192.0.2.5")
+			self._gen_failure("192.0.2.5")
 			self.assertFalse(self.jail.getFailTicket())
 
 			# now the same with increased time (check now - findtime case):
@@ -1561,7 +1579,7 @@ def get_monitor_failures_journal_testcase(Filter_): # pragma: systemd no cover
 			self.waitForTicks(2)
 			MyTime.setTime(time.time() + 20)
 			# check new IP but no old IPs found:
-			_gen_falure("192.0.2.6")
+			self._gen_failure("192.0.2.6")
 			self.assertFalse(self.jail.getFailTicket())
 
 			# now reset DB, so we'd find all messages before filter entering in operation mode:
@@ -1595,6 +1613,35 @@ def get_monitor_failures_journal_testcase(Filter_): # pragma: systemd no cover
 			self.assertTrue(Utils.wait_for(lambda: len(states) == 12, _maxWaitTime(10)))
 			self.assertEqual(states[-1], "** in operation")
 
+		@with_alt_time
+		def test_resume_from_cursor_with_db(self):
+			self.jail.database = getFail2BanDb(':memory:')
+			self.jail.database.addJail(self.jail)
+			MyTime.setTime(time.time())
+			self._initFilter()
+			self.filter.setMaxRetry(1)
+			self.filter.start()
+			self.waitForTicks(1)
+			for ip in ("192.0.2.7", "192.0.2.8"):
+				self._gen_failure(ip)
+			# stop (position of last processed entry gets stored):
+			self.filter.stop()
+			self.filter.join()
+			cursor = self.jail.database.getJournalCursor(self.jail, 'systemd-journal')
+			self.assertTrue(cursor)
+			# new failure while stopped:
+			self._gen_failure("192.0.2.9", check=False)
+			# restart - filter continues exactly after stored cursor (no step back,
+			# so entries up to the cursor are not processed again, but later ones are):
+			self._failTotal = 0
+			self._initFilter()
+			self.filter.setMaxRetry(1)
+			self.filter.start()
+			self.assert_correct_ban("192.0.2.9", 1)
+			self.waitForTicks(2)
+			self.assertFalse(self.jail.getFailTicket())
+			self.assertEqual(self.filter.failManager.getFailTotal(), 1)
+
 		def test_delJournalMatch(self):
 			self._initFilter()
 			self.filter.start()
@@ -1616,6 +1663,11 @@ def get_monitor_failures_journal_testcase(Filter_): # pragma: systemd no cover
 				self.test_file, self.journal_fields, n=5, skip=5)
 			# so we should get no more failures detected
 			self.assertTrue(self.isEmpty(10))
+			# already removed (or unknown) match:
+			self.assertRaises(ValueError, self.filter.delJournalMatch, [
+				"SYSLOG_IDENTIFIER=fail2ban-testcases",
+				"TEST_FIELD=1",
+				"TEST_UUID=%s" % self.test_uuid])
 
 			# but then if we add it back again
 			self.filter.addJournalMatch([
@@ -1628,6 +1680,59 @@ def get_monitor_failures_journal_testcase(Filter_): # pragma: systemd no cover
 			# we should detect the failures
 			self.assertTrue(self.isFilled(10))
 
+		def test_reopen_stale_reader(self):
+			self._initFilter()
+			self.filter.sleeptime = 0.2
+			self.filter.start()
+			self.waitForTicks(1); # wait for start
+			_copy_lines_to_journal(
+				self.test_file, self.journal_fields, n=5)
+			self.assert_correct_ban("193.168.0.128", 3)
+			jnl = self.filter.getJournalReader()
+			# simulate rotation (signal invalidate once):
+			waits = []
+			def _wait(*args):
+				return waits.pop() if waits else journal.Reader.wait(jnl, *args)
+			jnl.wait = _wait
+			waits.append(journal.INVALIDATE)
+			self.assertTrue(Utils.wait_for(lambda: not waits, _maxWaitTime(10)))
+			# no new matching entries - the reader remains (not reopened):
+			time.sleep(self.filter.sleeptime * 5)
+			self.assertIs(self.filter.getJournalReader(), jnl)
+			# reader hangs after rotation (returns no entries anymore):
+			jnl.get_next = lambda *args: {}
+			waits.append(journal.INVALIDATE)
+			_copy_lines_to_journal(
+				self.test_file, self.journal_fields, skip=5, n=4)
+			# new reader replaces stale one and continues after last processed entry:
+			self.assertTrue(Utils.wait_for(
+				lambda: self.filter.getJournalReader() is not jnl, _maxWaitTime(10)))
+			self.assert_correct_ban("193.168.0.128", 3)
+
+		def test_malformed_entry(self):
+			self._initFilter()
+			errors = []
+			self.filter.commonError = lambda reason="common", exc=None: errors.append(exc)
+			# mock-up format error on malformed entry:
+			formatJournalEntry = self.filter.formatJournalEntry
+			def _format(logentry):
+				if logentry.get('MESSAGE') == "malformed entry":
+					raise AttributeError("malformed entry")
+				return formatJournalEntry(logentry)
+			self.filter.formatJournalEntry = _format
+			# write entries before start (read at once by catch-up), malformed entry in-between:
+			_copy_lines_to_journal(
+				self.test_file, self.journal_fields, n=2)
+			fields = self.journal_fields
+			fields.update(TEST_JOURNAL_FIELDS)
+			journal.send(MESSAGE="malformed entry", **fields)
+			_copy_lines_to_journal(
+				self.test_file, self.journal_fields, skip=2, n=3)
+			self.filter.start()
+			# all entries before and after malformed entry are processed:
+			self.assert_correct_ban("193.168.0.128", 3)
+			self.assertEqual(len(errors), 1)
+
 		def test_WrongChar(self):
 			self._initFilter()
 			self.filter.start()
@@ -888,6 +888,12 @@ class Transmitter(TransmitterBase):
 		result = self.transm.proceed(
 			["set", jailName, "addjournalmatch", value])
 		self.assertTrue(isinstance(result[1], ValueError))
+		# Invalid element in compound match (nothing added):
+		result = self.transm.proceed(
+			["set", jailName, "addjournalmatch", "_COMM=sshd", "+", "__CURSOR=invalid"])
+		self.assertTrue(isinstance(result[1], ValueError))
+		self.assertEqual(
+			self.transm.proceed(["get", jailName, "journalmatch"]), (0, []))
 
 		# Delete invalid match
 		value = "FIELD=NotPresent"